@@ -1,13 +1,16 @@
 #!/usr/bin/env python3
 
 import requests
-import json
-import glob
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from requests_toolbelt import MultipartEncoder
 import os
 import hashlib
 import sys
 import argparse
-from concurrent.futures import ThreadPoolExecutor
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 sys.tracebacklimit = 0
 
@@ -17,6 +20,32 @@ def get_input(inp):
     else:
         return raw_input(inp)
 
+def calcmd5(filePath="."):
+    """
+    Calculate the md5 of a file, returns a (filePath, md5) tuple.
+
+    Lives at module level so it can be dispatched to worker processes.
+    """
+    with open(filePath, 'rb', buffering=0) as fh:
+        if hasattr(os, 'posix_fadvise'):
+            # Let the kernel read ahead more aggressively, the file is read
+            # once from start to end.
+            os.posix_fadvise(fh.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+        if hasattr(hashlib, 'file_digest'):
+            # Python 3.11+ runs the read loop in C
+            return filePath, hashlib.file_digest(fh, 'md5').hexdigest()
+
+        m = hashlib.md5()
+        buf = bytearray(1 << 20)
+        view = memoryview(buf)
+        while True:
+            size = fh.readinto(buf)
+            if not size:
+                break
+            m.update(view[:size])
+    return filePath, m.hexdigest()
+
 class ServerError(Exception):
     pass
 
@@ -51,18 +80,52 @@ class Uploader(object):
         # Initialise our variables that each function will set.
         self.user_id = None
         self.token = None
+        self.upload_fields = None
         self.supported = None
         self.files = None
+        self.file_stats = None
         self.skipped_files = None
         self.failed_files = None
         self.md5_int_path = None
         self.md5_int = None
         self.md5_ext = None
+        self.md5_ext_future = None
+        self.inode_md5 = {}
+        self.progress_width = 0
+        self.lock = threading.Lock()
         self.reupload = reupload
         self.tag = tag
         self.playlist = playlist
         self.parallel_uploads = parallel_uploads
 
+        # Share one session (and its keep-alive connections) between all
+        # requests instead of doing a new handshake for every call.
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = self.USER_AGENT
+        # Uploads stream their body, so only retry when the connection
+        # couldn't be made at all and nothing has been sent yet.
+        adapter = HTTPAdapter(
+            pool_connections=16,
+            pool_maxsize=max(16, parallel_uploads),
+            max_retries=Retry(connect=5, read=0, status=0, backoff_factor=0.5)
+        )
+        self.session.mount('https://', adapter)
+        # The API calls are small JSON POSTs that are safe to repeat, retry
+        # them on gateway errors as well.
+        api_adapter = HTTPAdapter(
+            max_retries=Retry(
+                total=5,
+                backoff_factor=0.5,
+                status_forcelist=[502, 503, 504],
+                allowed_methods=['POST'],
+                raise_on_status=False
+            )
+        )
+        self.session.mount('https://api.ibroadcast.com', api_adapter)
+
+        # Used to fetch the uploaded md5 list while the library is scanned
+        self.md5_ext_pool = ThreadPoolExecutor(max_workers=1)
+
     def process(self):
         try:
             self.login()
@@ -100,7 +163,7 @@ class Uploader(object):
             print('Logging in...')
 
         # Build a request object.
-        post_data = json.dumps({
+        post_data = {
             'mode' : 'login_token',
             'login_token': login_token,
             'app_id': 1007,
@@ -109,11 +172,10 @@ class Uploader(object):
             'client': self.CLIENT,
             'device_name' : self.DEVICE_NAME,
             'user_agent' : self.USER_AGENT
-        })
-        response = requests.post(
+        }
+        response = self.session.post(
             "https://api.ibroadcast.com/s/JSON/",
-            data=post_data,
-            headers={'Content-Type': 'application/json', 'User-Agent': self.USER_AGENT}
+            json=post_data
         )
 
         if not response.ok:
@@ -131,6 +193,17 @@ class Uploader(object):
         self.user_id = jsoned['user']['id']
         self.token = jsoned['user']['token']
 
+        # Form fields sent along with every upload, unset options are left
+        # out of the request entirely.
+        upload_fields = {
+            'user_id': str(self.user_id),
+            'token': self.token,
+            'method': self.CLIENT,
+            'tag-name': self.tag,
+            'playlist-name': self.playlist
+        }
+        self.upload_fields = {key: value for key, value in upload_fields.items() if value is not None}
+
     def get_supported_types(self):
         """
         Get supported file types
@@ -143,7 +216,7 @@ class Uploader(object):
             print('Fetching account info...')
 
         # Build a request object.
-        post_data = json.dumps({
+        post_data = {
             'mode' : 'status',
             'user_id': self.user_id,
             'token': self.token,
@@ -152,11 +225,10 @@ class Uploader(object):
             'client': self.CLIENT,
             'device_name' : self.DEVICE_NAME,
             'user_agent' : self.USER_AGENT
-        })
-        response = requests.post(
+        }
+        response = self.session.post(
             "https://api.ibroadcast.com/s/JSON/",
-            data=post_data,
-            headers={'Content-Type': 'application/json', 'User-Agent': self.USER_AGENT}
+            json=post_data
         )
 
         if not response.ok:
@@ -171,19 +243,25 @@ class Uploader(object):
         if self.be_verbose:
             print('Account info fetched')
 
-        self.supported = []
+        # Normalise to lowercase ".ext" so lookups don't depend on how the
+        # server or the file names spell them.
+        self.supported = frozenset(
+            '.' + filetype['extension'].lower().lstrip('.')
+            for filetype in jsoned['supported']
+        )
         self.files = []
+        self.file_stats = {}
         self.skipped_files = []
         self.failed_files = []
 
-        for filetype in jsoned['supported']:
-             self.supported.append(filetype['extension'])
+        # Start fetching the md5s of already uploaded files, it's only needed
+        # once the local files have been found.
+        self.md5_ext_future = self.md5_ext_pool.submit(self.__load_md5_ext)
 
-    def load_files(self, directory=None):
+    def load_files(self):
         """
-        Load all files in the directory that match the supported extension list.
-
-        directory defaults to present working directory.
+        Load all files in the present working directory and below that match
+        the supported extension list.
 
         raises:
             ValueError if supported is not yet set.
@@ -191,24 +269,57 @@ class Uploader(object):
         if self.supported is None:
             raise ValueError('Supported not yet set - have you logged in yet?')
 
-        if not directory:
-            directory = os.getcwd()
-
-        for full_filename in glob.glob(os.path.join(glob.escape(directory), '*')):
-            filename = os.path.basename(full_filename)
-            # Skip hidden files.
-            if filename.startswith('.'):
+        supported = self.supported
+        append = self.files.append
+        stats = self.file_stats
+
+        verbose = self.be_verbose and not self.be_silent
+
+        # Walk the tree with scandir, the entry names and types come straight
+        # from the directory listing without an extra stat() per file.
+        stack = [os.getcwd()]
+        visited = set()
+        while stack:
+            directory = stack.pop()
+            try:
+                # Symlinks may point back up the tree, only walk every
+                # directory once.
+                st = os.stat(directory)
+                key = (st.st_dev, st.st_ino) if st.st_ino else directory
+                if key in visited:
+                    continue
+                visited.add(key)
+
+                with os.scandir(directory) as entries:
+                    entries = list(entries)
+            except OSError as e:
+                # Skip directories we can't read instead of giving up.
+                if verbose:
+                    print('Skipping directory %s: %s' % (directory, e))
                 continue
 
-            # Make sure it's a supported extension.
-            dummy, ext = os.path.splitext(full_filename)
-            if ext in self.supported:
-                self.files.append(full_filename)
+            for entry in entries:
+                name = entry.name
+                # Skip hidden files.
+                if name.startswith('.'):
+                    continue
+
+                # Descend into subdirectories.
+                if entry.is_dir():
+                    stack.append(entry.path)
+                    continue
 
-            # Recurse into subdirectories.
-            # XXX Symlinks may cause... issues.
-            if os.path.isdir(full_filename):
-                self.load_files(full_filename)
+                # Make sure it's a supported extension.
+                head, dot, ext = name.rpartition('.')
+                if dot and dot + ext.lower() in supported:
+                    try:
+                        stats[entry.path] = entry.stat()
+                    except OSError as e:
+                        # Broken symlinks and files removed while walking
+                        if verbose:
+                            print('Skipping file %s: %s' % (entry.path, e))
+                        continue
+                    append(entry.path)
 
     def confirm(self):
         """
@@ -240,27 +351,31 @@ class Uploader(object):
 
     def __load_md5_int(self):
         """
-        Load internal md5 database to not calculate everything from scratch
+        Open internal md5 database to not calculate everything from scratch
         """
-        self.md5_int_path = os.getenv('HOME') + '/.ibroadcast_md5s'
-
-        if os.path.exists(self.md5_int_path):
-            with open(self.md5_int_path) as json_file:
-                self.md5_int = json.load(json_file)
-        else:
-            self.md5_int = {}
+        self.md5_int_path = os.getenv('HOME') + '/.ibroadcast_md5s.db'
+
+        self.md5_int = sqlite3.connect(self.md5_int_path)
+        self.md5_int.execute('PRAGMA journal_mode=WAL')
+        self.md5_int.execute('PRAGMA synchronous=NORMAL')
+        self.md5_int.execute(
+            'CREATE TABLE IF NOT EXISTS hashes('
+            'path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, md5 TEXT)'
+        )
 
     def __load_md5_ext(self):
         """
         Reach out to iBroadcast and get an md5.
         """
-        post_data = "user_id=%s&token=%s" % (self.user_id, self.token)
+        post_data = {
+            'user_id': self.user_id,
+            'token': self.token
+        }
 
         # Send our request.
-        response = requests.post(
+        response = self.session.post(
             "https://upload.ibroadcast.com",
-            data=post_data,
-            headers={'Content-Type': 'application/x-www-form-urlencoded'}
+            data=post_data
         )
 
         if not response.ok:
@@ -269,76 +384,109 @@ class Uploader(object):
 
         jsoned = response.json()
 
-        self.md5_ext = jsoned['md5']
+        # Looked up once per local file, a set avoids scanning the whole list
+        self.md5_ext = set(jsoned['md5'])
 
-    def calcmd5(self, filePath="."):
-        with open(filePath, 'rb') as fh:
-            m = hashlib.md5()
-            while True:
-                data = fh.read(8192)
-                if not data:
-                    break
-                m.update(data)
-        return m.hexdigest()
+    def __store_md5(self, filename, file_md5):
+        """
+        Save the md5 of a file in the internal md5 database
+        """
+        st = self.file_stats[filename]
+        self.md5_int.execute(
+            'INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?)',
+            (filename, st.st_size, st.st_mtime_ns, file_md5)
+        )
 
     def check_md5(self):
+        """
+        Yield the files that have not been uploaded yet as soon as their md5
+        is known. Files without a cached md5 are hashed in the background so
+        uploads can start while the rest of the library is still being hashed.
+        """
         self.__load_md5_int()
-        self.__load_md5_ext()
-
-        print_filename_again = True
-        current_path=''
-        file_list = self.files[:]
-        if not self.be_silent and not self.be_verbose:
-            file_list = self.progressbar(self.files[:], "Calculating MD5 hashes: ", 60)
-
-        for filename in file_list:
-            file_base_name = ' "' + os.path.basename(filename) + '"'
-            if not self.be_silent and self.be_verbose:
-                if os.path.dirname(filename) != current_path:
-                    current_path = os.path.dirname(filename)
-                    print('\nChecking directory %s...' % current_path)
-
-            # Get an md5 of the file contents and compare it to whats up
-            # there already
-            if (not self.no_cache) and filename in self.md5_int:
-                file_md5 = self.md5_int[filename]
+        self.md5_ext_future.result()
+        # Make sure no threads are left when the hashing processes are forked
+        self.md5_ext_pool.shutdown()
+
+        # Only hash the files we don't know the md5 for yet, or that changed
+        # since it was cached, spread over all available cores. Hardlinks and
+        # files reached through symlinks share an inode, so each inode is only
+        # hashed once.
+        cached = []
+        uncached = {}
+        for filename in self.files:
+            st = self.file_stats[filename]
+            # Not every filesystem provides inode numbers
+            key = (st.st_dev, st.st_ino) if st.st_ino else filename
+            row = None
+            if not self.no_cache:
+                row = self.md5_int.execute(
+                    'SELECT md5 FROM hashes WHERE path=? AND size=? AND mtime_ns=?',
+                    (filename, st.st_size, st.st_mtime_ns)
+                ).fetchone()
+            if row:
+                cached.append((filename, row[0]))
+                self.inode_md5[key] = row[0]
             else:
-                # We don't want to print the filename later
-                # when telling the user it has been skipped,
-                # because it's being printed here already
-                print_filename_again = False
-                if not self.be_silent and self.be_verbose:
-                    print('Calculating MD5 for file%s... ' % file_base_name, end='')
-                file_md5 = self.calcmd5(filename)
-                self.md5_int[filename] = file_md5
-
+                uncached.setdefault(key, []).append(filename)
+
+        for key in [key for key in uncached if key in self.inode_md5]:
+            for filename in uncached.pop(key):
+                self.__store_md5(filename, self.inode_md5[key])
+                cached.append((filename, self.inode_md5[key]))
+
+        verbose = self.be_verbose and not self.be_silent
+        def needs_upload(filename, file_md5, is_cached):
+            # Files come in by size rather than by directory, so show the
+            # full path. Only build it when it is going to be shown.
+            if verbose:
+                file_name = ' "' + filename + '"'
+                if not is_cached:
+                    print('Calculated MD5 for file%s' % file_name)
+
+            # Compare the md5 of the file contents to whats up there already
             if file_md5 in self.md5_ext and self.reupload is False:
                 self.skipped_files.append(filename)
-                if not self.be_silent and self.be_verbose:
-                    if not print_filename_again:
-                        file_base_name = ""
-                    print('Skipping%s, already uploaded.' % file_base_name)
-                # Removing the files is faster than later comparing
-                # which files are present in self.skipped_files
-                self.files.remove(filename)
-            elif not self.be_silent and self.be_verbose:
-                # Add a new line if the file has not been skipped and is not
-                # cached, because the last print doesn't include an end line
-                if not print_filename_again:
-                    print()
-                    continue
-                print('The MD5 for%s is cached, but the file has not been uploaded yet' % file_base_name)
-            print_filename_again = True
-
-        with open(self.md5_int_path, 'w') as fp:
-            json.dump(self.md5_int, fp, indent = 2)
+                if verbose:
+                    print('Skipping%s, already uploaded.' % file_name)
+                return False
+            if verbose and is_cached:
+                print('The MD5 for%s is cached, but the file has not been uploaded yet' % file_name)
+            return True
 
-    def progressbar(self, it, prefix="", size=60, out=sys.stdout):
-        count = len(it)
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as exe:
+            # Start hashing before any upload threads are running.
+            results = exe.map(calcmd5, [paths[0] for paths in uncached.values()], chunksize=8)
+
+            for filename, file_md5 in cached:
+                if needs_upload(filename, file_md5, True):
+                    yield filename
+
+            if uncached and not self.be_silent and not self.be_verbose:
+                results = self.progressbar(results, "Calculating MD5 hashes: ", 60, count=len(uncached))
+
+            for i, ((dummy, file_md5), key) in enumerate(zip(results, list(uncached))):
+                self.inode_md5[key] = file_md5
+                for filename in uncached[key]:
+                    self.__store_md5(filename, file_md5)
+                    if needs_upload(filename, file_md5, False):
+                        yield filename
+                # Don't lose everything if the run gets interrupted
+                if i % 100 == 99:
+                    self.md5_int.commit()
+
+        self.md5_int.commit()
+        self.md5_int.close()
+
+    def progressbar(self, it, prefix="", size=60, out=sys.stdout, count=None):
+        if count is None:
+            count = len(it)
         def show(j):
             x = int(size*j/count)
-            print("{}[{}{}] {}/{}".format(prefix, "#"*x, "."*(size-x), j, count),
-                end='\r', file=out, flush=True)
+            line = "{}[{}{}] {}/{}".format(prefix, "#"*x, "."*(size-x), j, count)
+            # Remember how wide the bar is so other messages can overwrite it
+            self.progress_width = len(line)
+            print(line, end='\r', file=out, flush=True)
         if (not self.be_verbose) and (not self.be_silent):
             show(0)
         for i, item in enumerate(it):
@@ -347,20 +495,39 @@ class Uploader(object):
                 show(i+1)
         if (not self.be_verbose) and (not self.be_silent):
             print("\n", flush=True, file=out)
+        self.progress_width = 0
 
     def prepare_upload(self):
         threads = self.parallel_uploads
         total_files = len(self.files)
-        # Remove already uploaded files from the list of files
-        self.check_md5()
-        not_skipped_files = len(self.files)
 
-        if not_skipped_files > 0:
-            with ThreadPoolExecutor(max_workers=threads) as exe:
-                for i in range(not_skipped_files):
-                    exe.submit(self.upload,self.files[i])
-                # Wait for all tasks to finish before continuing
-                exe.shutdown(wait=True)
+        # Handle the largest files first, so the workers don't end up idle
+        # waiting for one big file to finish at the end.
+        self.files.sort(key=lambda f: self.file_stats[f].st_size, reverse=True)
+
+        # Files are handed to the upload workers as soon as they are known
+        # not to be uploaded yet, while the rest is still being hashed. Only
+        # keep a couple of uploads queued per worker.
+        pending = threading.BoundedSemaphore(threads * 2)
+
+        def upload_done(future, filename):
+            pending.release()
+            error = future.exception()
+            # upload() reports the failures it expects itself, anything else
+            # (like a malformed reply) ends up here.
+            if error and not self.be_silent:
+                print('Upload of %s failed: %r' % (filename, error))
+            if error or not future.result():
+                with self.lock:
+                    self.failed_files.append(filename)
+
+        with ThreadPoolExecutor(max_workers=threads) as exe:
+            for filename in self.check_md5():
+                pending.acquire()
+                future = exe.submit(self.upload, filename)
+                future.add_done_callback(lambda f, filename=filename: upload_done(f, filename))
+            # Wait for all tasks to finish before continuing
+            exe.shutdown(wait=True)
 
         skipped = len(self.skipped_files)
         failed = len(self.failed_files)
@@ -370,42 +537,45 @@ class Uploader(object):
     def upload(self, filename):
         """
         Go and perform an upload of any files that haven't yet been uploaded
-        """
-        if not self.be_silent:
-            print('Uploading:', filename)
-
-        upload_file = open(filename, 'rb')
-
-        file_data = {
-            'file': upload_file,
-        }
-
-        post_data = {
-            'user_id': self.user_id,
-            'token': self.token,
-            'file_path' : filename,
-            'method': self.CLIENT,
-            'tag-name': self.tag,
-            'playlist-name': self.playlist
-        }
 
-        response = requests.post(
-            "https://upload.ibroadcast.com",
-            post_data,
-            files=file_data,
-        )
+        The upload endpoint takes a single file_path/file pair and answers
+        with a single result, so files can't be batched into one request.
 
-        upload_file.close()
+        Returns:
+            True if the file was uploaded, False otherwise
+        """
+        if not self.be_silent:
+            # Pad the message to overwrite the progress bar, if there is one
+            print(('Uploading: %s' % filename).ljust(self.progress_width))
 
-        if not response.ok:
-            raise ServerError('Server returned bad status: ',
-                response.status_code)
-        jsoned = response.json()
-        result = jsoned['result']
+        try:
+            with open(filename, 'rb') as upload_file:
+                post_data = dict(self.upload_fields)
+                post_data['file_path'] = filename
+                # Stream the body from disk instead of building it in memory.
+                post_data['file'] = (os.path.basename(filename), upload_file, 'application/octet-stream')
+                encoder = MultipartEncoder(fields=post_data)
+
+                response = self.session.post(
+                    "https://upload.ibroadcast.com",
+                    data=encoder,
+                    headers={'Content-Type': encoder.content_type}
+                )
+
+            if not response.ok:
+                raise ServerError('Server returned bad status: %s' % response.status_code)
+            result = response.json()['result']
+        except (ServerError, requests.RequestException, OSError) as e:
+            if not self.be_silent:
+                print('Upload of %s failed: %s' % (filename, e))
+            return False
 
         if result is False:
-            self.failed_files.append(filename)
-            raise ValueError('File upload failed.')
+            if not self.be_silent:
+                print('Upload of %s failed.' % filename)
+            return False
+
+        return True
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Run this script in the parent directory of your music files. To acquire a login token, enable the \"Simple Uploaders\" app by visiting https://ibroadcast.com, logging in to your account, and clicking the \"Apps\" button in the side menu.\n")
@@ -414,7 +584,7 @@ if __name__ == '__main__':
     parser.add_argument('directory', type=str, nargs='?', help='Use this directory instead of the current one')
     parser.add_argument('-n', '--no-cache', action='store_true', help='Do not use local MD5 cache')
     parser.add_argument('-v', '--verbose', action='store_true', help='Be verbose')
-    parser.add_argument('-p', '--parallel-uploads', type=int, nargs='?', const=3, default=3, choices=range(1,7), metavar='1-6', help='Number of parallel uploads, 3 by default.')
+    parser.add_argument('-p', '--parallel-uploads', type=int, nargs='?', const=3, default=3, choices=range(1,33), metavar='1-32', help='Number of parallel uploads, 3 by default.')
     parser.add_argument('-s', '--silent', action='store_true', help='Be silent')
     parser.add_argument('-y', '--skip-confirmation', action='store_true', help='Skip confirmation dialogue')
     parser.add_argument('-l', '--playlist', type=str, help='Add uploaded files to this playlist')